@@ -8,6 +8,7 @@
     (if server supports HTTP/1.1)
   - sends protocol 'version', per JSON-RPC 1.1
   - sends proper, incrementing 'id'
+  - supports JSON-RPC batch requests
   - sends Basic HTTP authentication headers
   - parses all JSON numbers that look like floats as Decimal
   - uses standard Python json lib
@@ -46,6 +47,9 @@ HTTP_TIMEOUT = 600
 
 log = logging.getLogger("BitcoinRPC")
 
+# Shared by all responses, rather than constructing a decoder on every call.
+_DECODER = json.JSONDecoder(parse_float=decimal.Decimal)
+
 class JSONRPCException(Exception):
     def __init__(self, rpc_error):
         Exception.__init__(self, rpc_error.get("message"))
@@ -97,7 +101,7 @@ class AuthServiceProxy():
             name = "%s.%s" % (self._service_name, name)
         return AuthServiceProxy(self.__service_url, name, connection=self.__conn)
 
-    def _request(self, method, path, postdata):
+    def _request(self, method, path, postdata, retry=True):
         '''
         Do a HTTP request, with retry if we get disconnected (e.g. due to a timeout).
         This is a workaround for https://bugs.python.org/issue3566 which is fixed in Python 3.5.
@@ -105,18 +109,18 @@ class AuthServiceProxy():
         headers = {'Host': self.__url.hostname,
                    'User-Agent': USER_AGENT,
                    'Authorization': self.__auth_header,
+                   'Connection': 'keep-alive',
                    'Content-type': 'application/json'}
         try:
             self.__conn.request(method, path, postdata, headers)
             return self._get_response()
         except Exception as e:
             # If connection was closed, try again.
-            # Python 3.5+ raises BrokenPipeError instead of BadStatusLine when the connection was reset.
-            # ConnectionResetError happens on FreeBSD with Python 3.4.
-            # This can be simplified now that we depend on Python 3 (previously, we could not
-            # refer to BrokenPipeError or ConnectionResetError which did not exist on Python 2)
-            if ((isinstance(e, BadStatusLine) and e.line == "''")
-                or e.__class__.__name__ in ('BrokenPipeError', 'ConnectionResetError')):
+            # Python 3.5+ raises BrokenPipeError instead of BadStatusLine when the connection was reset,
+            # and RemoteDisconnected (a ConnectionResetError) when the server has closed an idle
+            # keep-alive connection.
+            if retry and ((isinstance(e, BadStatusLine) and e.line == "''")
+                or isinstance(e, (BrokenPipeError, ConnectionResetError))):
                 self.__conn.close()
                 self.__conn.request(method, path, postdata, headers)
                 return self._get_response()
@@ -141,10 +145,47 @@ class AuthServiceProxy():
         else:
             return response['result']
 
-    def _batch(self, rpc_call_list):
+    def _batch(self, rpc_call_list, retry=True):
         postdata = json.dumps(list(rpc_call_list), default=EncodeDecimal)
         log.debug("--> "+postdata)
-        return self._request('POST', self.__url.path, postdata)
+        return self._request('POST', self.__url.path, postdata, retry)
+
+    def batch(self, calls):
+        '''
+        Send a list of (method, params) pairs to the server as a single JSON-RPC
+        batch request, and return their results in the same order as the calls.
+        Raises JSONRPCException for the first call that returned an error.
+
+        A batch may contain calls that are not safe to repeat (such as
+        z_shieldcoinbase), and after a disconnect we cannot tell whether the
+        server already ran them. So the batch is sent on a fresh connection,
+        which cannot have been closed by the server for being idle, and is
+        never retried.
+        '''
+        requests = []
+        for (method, params) in calls:
+            AuthServiceProxy.__id_count += 1
+            requests.append({'version': '1.1',
+                             'method': method,
+                             'params': params,
+                             'id': AuthServiceProxy.__id_count})
+        self.__conn.close()
+        response = self._batch(requests, retry=False)
+        if isinstance(response, dict):
+            # The batch as a whole was rejected by the server.
+            raise JSONRPCException(response['error'])
+
+        responses = {r['id']: r for r in response}
+        results = []
+        for request in requests:
+            if request['id'] not in responses:
+                raise JSONRPCException({
+                    'code': -343, 'message': 'missing JSON-RPC result'})
+            r = responses[request['id']]
+            if r['error'] is not None:
+                raise JSONRPCException(r['error'])
+            results.append(r['result'])
+        return results
 
     def _get_response(self):
         http_response = self.__conn.getresponse()
@@ -158,7 +199,7 @@ class AuthServiceProxy():
                 'code': -342, 'message': 'non-JSON HTTP response with \'%i %s\' from server' % (http_response.status, http_response.reason)})
 
         responsedata = http_response.read().decode('utf8')
-        response = json.loads(responsedata, parse_float=decimal.Decimal)
+        response = _DECODER.decode(responsedata)
         if "error" in response and response["error"] is None:
             log.debug("<-%s- %s"%(response["id"], json.dumps(response["result"], default=EncodeDecimal)))
         else:
@@ -56,6 +56,21 @@ class AuthServiceProxyWrapper(object):
 
         return return_val
 
+    def batch(self, calls):
+        """
+        Delegates to AuthServiceProxy.batch, then writes each RPC method in
+        the batch to a file.
+
+        """
+        return_val = self.auth_service_proxy_instance.batch(calls)
+
+        if self.coverage_logfile:
+            with open(self.coverage_logfile, 'a+', encoding='utf8') as f:
+                for (rpc_method, _) in calls:
+                    f.write("%s\n" % rpc_method)
+
+        return return_val
+
     @property
     def url(self):
         return self.auth_service_proxy_instance.url
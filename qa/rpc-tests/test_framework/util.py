@@ -651,6 +651,12 @@ def assert_equal(expected, actual, message=""):
             message = "; %s" % message
         raise AssertionError("(left == right)%s\n  left: <%s>\n right: <%s>" % (message, str(expected), str(actual)))
 
+# Asserts that two collections have the same elements, ignoring order. Cheaper
+# than comparing sets for the short lists used in tests; unlike a set
+# comparison, repeated elements must also match.
+def assert_set_equal(expected, actual, message=""):
+    assert_equal(sorted(expected), sorted(actual), message)
+
 def assert_true(condition, message = ""):
     if not condition:
         raise AssertionError(message)
@@ -697,6 +703,10 @@ def wait_and_assert_operationid_status_result(node, myopid, in_status='success',
         time.sleep(1)
 
     assert_true(result is not None, "timeout occurred")
+    _assert_operation_result(result, in_status, in_errormsg)
+    return result
+
+def _assert_operation_result(result, in_status, in_errormsg):
     status = result['status']
 
     debug = os.getenv("PYTHON_DEBUG", "")
@@ -712,8 +722,6 @@ def wait_and_assert_operationid_status_result(node, myopid, in_status='success',
 
     assert_equal(in_status, status, "Operation returned mismatched status. Error Message: {}".format(errormsg))
 
-    return result
-
 
 # Returns txid if operation was a success or None
 def wait_and_assert_operationid_status(node, myopid, in_status='success', in_errormsg=None, timeout=300):
@@ -723,12 +731,38 @@ def wait_and_assert_operationid_status(node, myopid, in_status='success', in_err
     else:
         return None
 
+# Waits for several async operations at once, polling all of them with a single
+# RPC per tick. Returns the txid of each operation (or None if it did not
+# succeed), in the same order as myopids.
+def wait_and_assert_operationids_status(node, myopids, in_status='success', in_errormsg=None, timeout=300):
+    print('waiting for async operations {}'.format(myopids))
+    results = {}
+    for _ in range(1, timeout):
+        pending = [opid for opid in myopids if opid not in results]
+        for result in node.z_getoperationresult(pending):
+            results[result['id']] = result
+        if len(results) == len(myopids):
+            break
+        time.sleep(1)
+
+    assert_true(len(results) == len(myopids), "timeout occurred")
+    txids = []
+    for opid in myopids:
+        result = results[opid]
+        _assert_operation_result(result, in_status, in_errormsg)
+        txids.append(result['result']['txid'] if result['status'] == "success" else None)
+    return txids
+
 # Find a coinbase address on the node, filtering by the number of UTXOs it has.
 # If no filter is provided, returns the coinbase address on the node containing
 # the greatest number of spendable UTXOs.
 # The default cached chain has one address per coinbase output.
-def get_coinbase_address(node, expected_utxos=None):
-    addrs = [utxo['address'] for utxo in node.listunspent() if utxo['generated']]
+# Callers looking up several addresses at the same wallet state can pass the
+# result of node.listunspent() as utxos, to avoid rescanning the wallet.
+def get_coinbase_address(node, expected_utxos=None, utxos=None):
+    if utxos is None:
+        utxos = node.listunspent()
+    addrs = [utxo['address'] for utxo in utxos if utxo['generated']]
     assert(len(set(addrs)) > 0)
 
     if expected_utxos is None:
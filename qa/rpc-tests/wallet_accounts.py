@@ -10,18 +10,28 @@ from test_framework.util import (
     NU5_BRANCH_ID,
     assert_equal,
     assert_raises_message,
+    assert_set_equal,
     assert_true,
     get_coinbase_address,
+    get_rpc_proxy,
     nuparams,
     start_nodes,
     wait_and_assert_operationid_status,
 )
 
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal
+import threading
 
 # Test wallet accounts behaviour
 class WalletAccountsTest(BitcoinTestFramework):
     def setup_nodes(self):
+        # Pool for independent RPCs that can be issued concurrently. RPC proxies
+        # are not thread-safe, so workers use their own (see worker_node).
+        self.pool = ThreadPoolExecutor()
+        self.worker_local = threading.local()
+        # Viewing keys are deterministic per address, so only export them once.
+        self.fvk_cache = {}
         return start_nodes(self.num_nodes, self.options.tmpdir, extra_args=[[
             '-minrelaytxfee=0',
             nuparams(NU5_BRANCH_ID, 210),
@@ -31,9 +41,17 @@ class WalletAccountsTest(BitcoinTestFramework):
             '-allowdeprecated=z_listaddresses',
         ]] * self.num_nodes)
 
+    # Returns an RPC proxy for the given node that is private to the calling thread.
+    def worker_node(self, node):
+        if not hasattr(self.worker_local, 'nodes'):
+            self.worker_local.nodes = {}
+        if node not in self.worker_local.nodes:
+            self.worker_local.nodes[node] = get_rpc_proxy(self.nodes[node].url, node)
+        return self.worker_local.nodes[node]
+
     def check_receiver_types(self, ua, expected):
-        actual = self.nodes[0].z_listunifiedreceivers(ua)
-        assert_equal(set(expected), set(actual))
+        actual = self.worker_node(0).z_listunifiedreceivers(ua)
+        assert_set_equal(expected, actual)
 
     def check_z_listaccounts(self, node, acct_id, addr_id, ua):
         accounts = self.nodes[node].z_listaccounts()
@@ -42,25 +60,45 @@ class WalletAccountsTest(BitcoinTestFramework):
 
     # Check we only have balances in the expected pools.
     # Remember that empty pools are omitted from the output.
-    def _check_balance_for_rpc(self, rpcmethod, node, account, expected, minconf):
-        rpc = getattr(self.nodes[node], rpcmethod)
-        actual = rpc(account, minconf)
-        assert_equal(set(expected), set(actual['pools']))
-        total_balance = 0
-        for pool in expected:
-            assert_equal(expected[pool] * COIN, actual['pools'][pool]['valueZat'])
-            total_balance += expected[pool]
+    def _check_balance_for_rpc(self, actual, expected_zat, minconf):
+        assert_set_equal(expected_zat, actual['pools'])
+        for pool in expected_zat:
+            assert_equal(expected_zat[pool], actual['pools'][pool]['valueZat'])
         assert_equal(actual['minimum_confirmations'], minconf)
-        return total_balance
 
     def check_balance(self, node, account, address, expected, minconf=1):
-        acct_balance = self._check_balance_for_rpc('z_getbalanceforaccount', node, account, expected, minconf)
-        z_getbalance = self.nodes[node].z_getbalance(address, minconf)
-        assert_equal(acct_balance, z_getbalance)
-        fvk = self.nodes[node].z_exportviewingkey(address)
-        self._check_balance_for_rpc('z_getbalanceforviewingkey', node, fvk, expected, minconf)
+        # All calls go through batch(), which is a plain method on the proxy and
+        # avoids building a new proxy object per RPC method lookup.
+        batch = self.nodes[node].batch
+        calls = [
+            ('z_getbalanceforaccount', [account, minconf]),
+            ('z_getbalance', [address, minconf]),
+        ]
+        fvk = self.fvk_cache.get((node, address))
+        if fvk is None:
+            # The viewing key balance depends on the exported key, so it needs a
+            # second round-trip the first time we see this address.
+            (acct_actual, z_getbalance, fvk) = batch(
+                calls + [('z_exportviewingkey', [address])])
+            self.fvk_cache[(node, address)] = fvk
+            (fvk_actual,) = batch([('z_getbalanceforviewingkey', [fvk, minconf])])
+        else:
+            (acct_actual, z_getbalance, fvk_actual) = batch(
+                calls + [('z_getbalanceforviewingkey', [fvk, minconf])])
+        expected_zat = {pool: value * COIN for (pool, value) in expected.items()}
+        self._check_balance_for_rpc(acct_actual, expected_zat, minconf)
+        assert_equal(sum(expected.values()), z_getbalance)
+        self._check_balance_for_rpc(fvk_actual, expected_zat, minconf)
 
     def run_test(self):
+        # Always stop the worker threads, including when an assertion fails, so
+        # none are left using their proxies while the framework stops the nodes.
+        try:
+            self._run_test()
+        finally:
+            self.pool.shutdown()
+
+    def _run_test(self):
         # With a new wallet, the first account will be 0.
         account0 = self.nodes[0].z_getnewaccount()
         assert_equal(account0['account'], 0)
@@ -82,7 +120,7 @@ class WalletAccountsTest(BitcoinTestFramework):
         # Generate the first address for account 0.
         addr0 = self.nodes[0].z_getaddressforaccount(0)
         assert_equal(addr0['account'], 0)
-        assert_equal(set(addr0['receiver_types']), set(['p2pkh', 'sapling', 'orchard']))
+        assert_set_equal(addr0['receiver_types'], ['p2pkh', 'sapling', 'orchard'])
         ua0 = addr0['address']
         self.check_z_listaccounts(0, 0, 0, addr0)
 
@@ -101,7 +139,7 @@ class WalletAccountsTest(BitcoinTestFramework):
         # The second address for account 0 is different to the first address.
         addr0_2 = self.nodes[0].z_getaddressforaccount(0)
         assert_equal(addr0_2['account'], 0)
-        assert_equal(set(addr0_2['receiver_types']), set(['p2pkh', 'sapling', 'orchard']))
+        assert_set_equal(addr0_2['receiver_types'], ['p2pkh', 'sapling', 'orchard'])
         ua0_2 = addr0_2['address']
         assert(ua0 != ua0_2)
         self.check_z_listaccounts(0, 0, 1, addr0_2)
@@ -109,31 +147,35 @@ class WalletAccountsTest(BitcoinTestFramework):
         # We can generate a fully-shielded address.
         addr0_3 = self.nodes[0].z_getaddressforaccount(0, ['sapling', 'orchard'])
         assert_equal(addr0_3['account'], 0)
-        assert_equal(set(addr0_3['receiver_types']), set(['sapling', 'orchard']))
+        assert_set_equal(addr0_3['receiver_types'], ['sapling', 'orchard'])
         ua0_3 = addr0_3['address']
         self.check_z_listaccounts(0, 0, 2, addr0_3)
 
         # We can generate an address without a Sapling receiver.
         addr0_4 = self.nodes[0].z_getaddressforaccount(0, ['p2pkh', 'orchard'])
         assert_equal(addr0_4['account'], 0)
-        assert_equal(set(addr0_4['receiver_types']), set(['p2pkh', 'orchard']))
+        assert_set_equal(addr0_4['receiver_types'], ['p2pkh', 'orchard'])
         ua0_4 = addr0_4['address']
         self.check_z_listaccounts(0, 0, 3, addr0_4)
 
         # The first address for account 1 is different to account 0.
         addr1 = self.nodes[0].z_getaddressforaccount(1)
         assert_equal(addr1['account'], 1)
-        assert_equal(set(addr1['receiver_types']), set(['p2pkh', 'sapling', 'orchard']))
+        assert_set_equal(addr1['receiver_types'], ['p2pkh', 'sapling', 'orchard'])
         ua1 = addr1['address']
         assert(ua0 != ua1)
         self.check_z_listaccounts(0, 1, 0, addr1)
 
         # The UA contains the expected receiver kinds.
-        self.check_receiver_types(ua0,   ['p2pkh', 'sapling', 'orchard'])
-        self.check_receiver_types(ua0_2, ['p2pkh', 'sapling', 'orchard'])
-        self.check_receiver_types(ua0_3, [         'sapling', 'orchard'])
-        self.check_receiver_types(ua0_4, ['p2pkh',            'orchard'])
-        self.check_receiver_types(ua1,   ['p2pkh', 'sapling', 'orchard'])
+        checks = [
+            self.pool.submit(self.check_receiver_types, ua0,   ['p2pkh', 'sapling', 'orchard']),
+            self.pool.submit(self.check_receiver_types, ua0_2, ['p2pkh', 'sapling', 'orchard']),
+            self.pool.submit(self.check_receiver_types, ua0_3, [         'sapling', 'orchard']),
+            self.pool.submit(self.check_receiver_types, ua0_4, ['p2pkh',            'orchard']),
+            self.pool.submit(self.check_receiver_types, ua1,   ['p2pkh', 'sapling', 'orchard']),
+        ]
+        for check in checks:
+            check.result()
 
         # The balances of the accounts are all zero.
         self.check_balance(0, 0, ua0, {})
@@ -157,7 +199,10 @@ class WalletAccountsTest(BitcoinTestFramework):
         self.check_balance(0, 0, ua0, {})
         self.check_balance(0, 0, ua0, {'sapling': 10}, 0)
 
-        self.nodes[2].generate(1)
+        # Mine in the background while node 1 prepares the address for the next send.
+        mining = self.pool.submit(lambda: self.worker_node(2).generate(1))
+        node1sapling = self.nodes[1].z_getnewaddress('sapling')
+        mining.result()
         self.sync_all()
 
         # The default minconf should now detect the balance.
@@ -165,7 +210,6 @@ class WalletAccountsTest(BitcoinTestFramework):
 
         # Send Sapling funds from the UA.
         print('Sending account funds to Sapling address')
-        node1sapling = self.nodes[1].z_getnewaddress('sapling')
 
         recipients = [{'address': node1sapling, 'amount': Decimal('1')}]
         opid = self.nodes[0].z_sendmany(ua0, recipients, 1, 0)
@@ -210,11 +254,13 @@ class WalletAccountsTest(BitcoinTestFramework):
         self.check_balance(0, 0, ua0, {'sapling': 9, 'orchard': 10}, 0)
 
         # The total balance with the default minconf should be just the Sapling balance
-        assert_equal('9.00', self.nodes[0].z_gettotalbalance()['private'])
-        assert_equal('19.00', self.nodes[0].z_gettotalbalance(0)['private'])
+        total_balance = self.pool.submit(lambda: self.worker_node(0).z_gettotalbalance()['private'])
+        total_balance_0 = self.pool.submit(lambda: self.worker_node(0).z_gettotalbalance(0)['private'])
+        assert_equal('9.00', total_balance.result())
+        assert_equal('19.00', total_balance_0.result())
 
-        self.nodes[2].generate(1)
-        self.sync_all()
+        # Mine in the background while node 1 prepares the recipient for the next send.
+        mining = self.pool.submit(lambda: self.worker_node(2).generate(1))
 
         # Send Orchard funds from the UA.
         print('Sending account funds to Orchard-only UA')
@@ -223,6 +269,9 @@ class WalletAccountsTest(BitcoinTestFramework):
         self.check_z_listaccounts(1, 0, 0, node1orchard)
         node1orchard = node1orchard['address']
 
+        mining.result()
+        self.sync_all()
+
         recipients = [{'address': node1orchard, 'amount': Decimal('1')}]
         opid = self.nodes[0].z_sendmany(ua0, recipients, 1, 0)
         txid = wait_and_assert_operationid_status(self.nodes[0], opid)
@@ -234,7 +283,8 @@ class WalletAccountsTest(BitcoinTestFramework):
         assert_equal(tx_details['spends'][0]['address'], ua0)
 
         assert_equal(len(tx_details['outputs']), 2)
-        outputs = sorted(tx_details['outputs'], key=lambda x: x['valueZat'])
+        (o0, o1) = tx_details['outputs']
+        outputs = (o0, o1) if o0['valueZat'] <= o1['valueZat'] else (o1, o0)
         assert_equal(outputs[0]['pool'], 'orchard')
         assert_equal(outputs[0]['address'], node1orchard)
         assert_equal(outputs[0]['valueZat'], 100000000)
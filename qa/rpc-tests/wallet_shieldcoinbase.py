@@ -7,10 +7,11 @@ from test_framework.test_framework import BitcoinTestFramework
 from test_framework.authproxy import JSONRPCException
 from test_framework.util import assert_equal, initialize_chain_clean, \
     start_node, connect_nodes_bi, sync_blocks, sync_mempools, \
-    wait_and_assert_operationid_status, get_coinbase_address, \
-    NU5_BRANCH_ID, nuparams
+    wait_and_assert_operationid_status, wait_and_assert_operationids_status, \
+    get_coinbase_address, NU5_BRANCH_ID, nuparams
 from test_framework.zip317 import conventional_fee, ZIP_317_FEE
 
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal
 
 class WalletShieldCoinbaseTest (BitcoinTestFramework):
@@ -28,43 +29,57 @@ class WalletShieldCoinbaseTest (BitcoinTestFramework):
             '-allowdeprecated=z_getbalance',
             '-debug=mempool',
         ]
-        self.nodes = []
-        self.nodes.append(start_node(0, self.options.tmpdir, args))
-        self.nodes.append(start_node(1, self.options.tmpdir, args))
-        self.nodes.append(start_node(2, self.options.tmpdir, args))
+        # Each start_node call blocks until that node's RPC interface is up, so start
+        # them concurrently. Keep the nodes that did start so they are shut down if
+        # another one failed.
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            starting = [executor.submit(start_node, i, self.options.tmpdir, args) for i in range(3)]
+        self.nodes = [f.result() for f in starting if f.exception() is None]
+        for f in starting:
+            if f.exception() is not None:
+                raise f.exception()
         connect_nodes_bi(self.nodes,0,1)
         connect_nodes_bi(self.nodes,1,2)
         connect_nodes_bi(self.nodes,0,2)
         self.is_network_split=False
         self.sync_all()
 
+    # Check the transparent balance of every node. Each node has its own RPC
+    # connection, so the queries are made concurrently.
+    def check_balances(self, expected):
+        with ThreadPoolExecutor(max_workers=len(self.nodes)) as executor:
+            actual = list(executor.map(lambda node: node.getbalance(), self.nodes))
+        assert_equal(expected, actual)
+
     def run_test (self):
         print("Mining blocks...")
 
+        # Each generate call mines to a fresh coinbase address, so these calls are
+        # kept separate: node 0 needs addresses holding 1 and 4 utxos, and node 2
+        # shields from several transparent addresses at once below.
         self.nodes[0].generate(1)
         self.nodes[0].generate(4)
         self.sync_all()
         walletinfo = self.nodes[0].getwalletinfo()
         assert_equal(walletinfo['immature_balance'], 50)
         assert_equal(walletinfo['balance'], 0)
-        self.sync_all()
         self.nodes[2].generate(1)
         self.nodes[2].generate(1)
         self.nodes[2].generate(1)
         self.sync_all()
         self.nodes[1].generate(101)
         self.sync_all()
-        assert_equal(self.nodes[0].getbalance(), 50)
-        assert_equal(self.nodes[1].getbalance(), 10)
-        assert_equal(self.nodes[2].getbalance(), 30)
+        self.check_balances([50, 10, 30])
 
         # create one zaddr that is the target of all shielding
         myzaddr = self.test_init_zaddr(self.nodes[0])
 
-        do_not_shield_taddr = get_coinbase_address(self.nodes[0], 1)
+        # Both coinbase addresses are looked up from the same wallet state.
+        utxos = self.nodes[0].listunspent()
+        do_not_shield_taddr = get_coinbase_address(self.nodes[0], 1, utxos)
 
         # Prepare to send taddr->zaddr
-        mytaddr = get_coinbase_address(self.nodes[0], 4)
+        mytaddr = get_coinbase_address(self.nodes[0], 4, utxos)
 
         # Shielding will fail when trying to spend from watch-only address
         self.nodes[2].importaddress(mytaddr)
@@ -110,11 +125,9 @@ class WalletShieldCoinbaseTest (BitcoinTestFramework):
         self.sync_all()
 
         # Confirm balances and that do_not_shield_taddr containing funds of 10 was left alone
-        assert_equal(self.nodes[0].getbalance(), 10)
+        self.check_balances([10, 20, 30])
         assert_equal(self.nodes[0].z_getbalance(do_not_shield_taddr), Decimal('10.0'))
         self.test_check_balance_zaddr(self.nodes[0], Decimal('40.0') - conventional_fee(6))
-        assert_equal(self.nodes[1].getbalance(), 20)
-        assert_equal(self.nodes[2].getbalance(), 30)
 
         # Shield coinbase utxos from any node 2 taddr, and set fee to 0
         result = self.nodes[2].z_shieldcoinbase("*", myzaddr, 0, None, None, 'AllowLinkingAccountAddresses')
@@ -123,10 +136,8 @@ class WalletShieldCoinbaseTest (BitcoinTestFramework):
         self.nodes[1].generate(1)
         self.sync_all()
 
-        assert_equal(self.nodes[0].getbalance(), 10)
+        self.check_balances([10, 30, 0])
         self.test_check_balance_zaddr(self.nodes[0], Decimal('70.0') - conventional_fee(6))
-        assert_equal(self.nodes[1].getbalance(), 30)
-        assert_equal(self.nodes[2].getbalance(), 0)
 
         # Generate 800 coinbase utxos on node 0, and 20 coinbase utxos on node 2
         self.nodes[0].generate(800)
@@ -138,26 +149,30 @@ class WalletShieldCoinbaseTest (BitcoinTestFramework):
         mytaddr = get_coinbase_address(self.nodes[0], 800)
 
         def verify_locking(first, second, limit):
-            result = self.nodes[0].z_shieldcoinbase(mytaddr, myzaddr, ZIP_317_FEE, limit)
-            assert_equal(result["shieldingUTXOs"], Decimal(first))
-            assert_equal(result["remainingUTXOs"], Decimal(second))
-            remainingValue = result["remainingValue"]
-            opid1 = result['opid']
-
-            # Verify that utxos are locked (not available for selection) by queuing up another shielding operation
-            result = self.nodes[0].z_shieldcoinbase(mytaddr, myzaddr, ZIP_317_FEE, 0)
-            assert_equal(result["shieldingValue"], Decimal(remainingValue))
-            assert_equal(result["shieldingUTXOs"], Decimal(second))
-            assert_equal(result["remainingValue"], Decimal('0'))
-            assert_equal(result["remainingUTXOs"], Decimal('0'))
-            opid2 = result['opid']
+            # Verify that utxos are locked (not available for selection) by queuing up another
+            # shielding operation. The server handles batched calls in order, so the second
+            # operation is created after the first has locked its utxos. Checking the second
+            # operation's selection (rather than just listlockunspent) shows that locked utxos
+            # are actually skipped when shielding.
+            (result1, result2) = self.nodes[0].batch([
+                ('z_shieldcoinbase', [mytaddr, myzaddr, ZIP_317_FEE, limit]),
+                ('z_shieldcoinbase', [mytaddr, myzaddr, ZIP_317_FEE, 0]),
+            ])
+            assert_equal(result1["shieldingUTXOs"], first)
+            assert_equal(result1["remainingUTXOs"], second)
+            opid1 = result1['opid']
+
+            assert_equal(result2["shieldingValue"], result1["remainingValue"])
+            assert_equal(result2["shieldingUTXOs"], second)
+            assert_equal(result2["remainingValue"], Decimal('0'))
+            assert_equal(result2["remainingUTXOs"], 0)
+            opid2 = result2['opid']
 
             # wait for both async operations to complete
-            wait_and_assert_operationid_status(self.nodes[0], opid1)
-            wait_and_assert_operationid_status(self.nodes[0], opid2)
+            wait_and_assert_operationids_status(self.nodes[0], [opid1, opid2])
 
         # Shield the 800 utxos over two transactions
-        verify_locking('500', '300', 500)
+        verify_locking(500, 300, 500)
 
         # sync_all() invokes sync_mempool() but node 2's mempool limit will cause tx1 and tx2 to be rejected.
         # So instead, we sync on blocks and mempool for node 0 and node 1, and after a new block is generated
@@ -172,14 +187,14 @@ class WalletShieldCoinbaseTest (BitcoinTestFramework):
         self.sync_all()
         mytaddr = get_coinbase_address(self.nodes[0], 100)
         result = self.nodes[0].z_shieldcoinbase(mytaddr, myzaddr, ZIP_317_FEE, None, 'DEADBEEF')
-        assert_equal(result["shieldingUTXOs"], Decimal('50'))
-        assert_equal(result["remainingUTXOs"], Decimal('50'))
+        assert_equal(result["shieldingUTXOs"], 50)
+        assert_equal(result["remainingUTXOs"], 50)
         wait_and_assert_operationid_status(self.nodes[0], result['opid'])
 
         # Verify maximum number of utxos which node 0 can shield can be set by the limit parameter
         result = self.nodes[0].z_shieldcoinbase(mytaddr, myzaddr, ZIP_317_FEE, 33, None)
-        assert_equal(result["shieldingUTXOs"], Decimal('33'))
-        assert_equal(result["remainingUTXOs"], Decimal('17'))
+        assert_equal(result["shieldingUTXOs"], 33)
+        assert_equal(result["remainingUTXOs"], 17)
         wait_and_assert_operationid_status(self.nodes[0], result['opid'])
         # Don't sync node 2 which rejects the tx due to its mempooltxinputlimit
         sync_blocks(self.nodes[:2])